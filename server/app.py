@@ -1,41 +1,99 @@
+import atexit
+import io
 import os
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, has_request_context
+from flask.json.provider import JSONProvider
 from flask_migrate import Migrate
 from flask_bcrypt import Bcrypt
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, get_jwt
 from datetime import timedelta
 from flask_cors import CORS
-from models import db, User, Product, Order, OrderItem, Category, ShippingAddress, Payment
+from flask_caching import Cache
+from models import db, from_cents, INSERT_ORDER_ITEM, User, Product, Order, OrderItem, Category, ShippingAddress, Payment, PaymentMethod, Cart, CartItem
 import logging
+import logging.handlers
+import queue
 from flask_restful import Api
 from dotenv import load_dotenv
-import random
-from sqlalchemy import func
+import redis
+import orjson
+from sqlalchemy import event, func
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, lazyload, load_only, raiseload, selectinload
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Compact JSON encoding backed by orjson
+class ORJSONProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=str).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app)
 
 # Configuration
 app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URI", "sqlite:///app.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY", "fsbdgfnhgvjnvhmvh" + str(random.randint(1, 1000000000000)))
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_recycle": int(os.getenv("SQLALCHEMY_POOL_RECYCLE", 3600)),
+    "pool_pre_ping": True,
+}
+# Pool sizing only applies to QueuePool; in-memory SQLite gets a StaticPool. A gthread
+# worker serves at most GUNICORN_THREADS requests at once, so it never needs more connections
+if make_url(app.config["SQLALCHEMY_DATABASE_URI"]).get_backend_name() != "sqlite":
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"].update({
+        "pool_size": int(os.getenv("SQLALCHEMY_POOL_SIZE", os.getenv("GUNICORN_THREADS", 8))),
+        "max_overflow": int(os.getenv("SQLALCHEMY_MAX_OVERFLOW", 0)),
+    })
+# Batch executemany INSERTs/UPDATEs into multi-row statements on psycopg2
+if make_url(app.config["SQLALCHEMY_DATABASE_URI"]).get_driver_name() == "psycopg2":
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"].update({
+        "executemany_mode": "values_plus_batch",
+        "insertmanyvalues_page_size": 1000,
+        "executemany_batch_page_size": 500,
+    })
+for secret_name in ("JWT_SECRET_KEY", "SECRET_KEY"):
+    secret_value = os.getenv(secret_name)
+    if not secret_value:
+        raise RuntimeError(f"{secret_name} must be set")
+    app.config[secret_name] = secret_value
 app.config["JWT_ACCESS_TOKEN_EXPIRES"] = timedelta(days=int(os.getenv("JWT_ACCESS_TOKEN_EXPIRES", 1)))
-app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "JKSRVHJVFBSRDFV" + str(random.randint(1, 1000000000000)))
-app.json.compact = False
+app.config["BCRYPT_LOG_ROUNDS"] = int(os.getenv("BCRYPT_LOG_ROUNDS", 11))
+# Cached entries must be shared across gunicorn workers so invalidation reaches all
+# of them; SimpleCache is per-process and only suitable without REDIS_URL (local development)
+app.config["CACHE_TYPE"] = os.getenv("CACHE_TYPE", "RedisCache" if os.getenv("REDIS_URL") else "SimpleCache")
+app.config["CACHE_REDIS_URL"] = os.getenv("REDIS_URL")
 
 # Initialize extensions
 bcrypt = Bcrypt(app)
 jwt = JWTManager(app)
 migrate = Migrate(app, db)
+cache = Cache(app)
 db.init_app(app)
 
+# SQLite only enforces foreign keys (and ON DELETE CASCADE) when asked to
+with app.app_context():
+    if db.engine.dialect.name == "sqlite":
+        @event.listens_for(db.engine, "connect")
+        def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+            dbapi_connection.execute("PRAGMA foreign_keys=ON")
+
 api = Api(app)
 
-# Configure logging
-logging.basicConfig(filename='app.log', level=logging.INFO)
+# Configure logging; records are written to app.log by a background listener
+log_queue = queue.SimpleQueue()
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(log_queue)])
+log_file_handler = logging.FileHandler('app.log')
+log_file_handler.setLevel(logging.INFO)
+log_listener = logging.handlers.QueueListener(log_queue, log_file_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 @app.before_request
 def log_request_info():
@@ -43,9 +101,30 @@ def log_request_info():
 
 @app.after_request
 def log_response_info(response):
-    logging.info(f"Response: {response.status} {response.get_data()}")
+    logging.info("Response: %s %s %s bytes", response.status, request.path, response.content_length or 0)
     return response
 
+# Warn about requests that issue too many queries (likely N+1); only registered in
+# debug mode (FLASK_DEBUG=1) so production statements are not counted
+QUERY_COUNT_WARNING_THRESHOLD = 20
+
+if app.debug:
+    @app.before_request
+    def start_query_count():
+        g.query_count = 0
+
+    with app.app_context():
+        @event.listens_for(db.engine, "before_cursor_execute")
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            if has_request_context():
+                g.query_count = g.get('query_count', 0) + 1
+
+    @app.after_request
+    def check_query_count(response):
+        if g.get('query_count', 0) > QUERY_COUNT_WARNING_THRESHOLD:
+            app.logger.warning("High query count %d on %s", g.query_count, request.path)
+        return response
+
 # Error handlers
 @app.errorhandler(404)
 def not_found(error):
@@ -61,21 +140,45 @@ def bad_request(error):
     return jsonify({"message": "Bad request"}), 400
 
 # JWT Blacklist
+# Revoked tokens live in Redis so every worker sees them; fall back to an
+# in-process set when REDIS_URL is not configured (local development).
+redis_url = os.getenv("REDIS_URL")
+redis_client = redis.Redis.from_url(redis_url) if redis_url else None
 BLACKLIST = set()
 
 @jwt.token_in_blocklist_loader
 def check_if_token_in_blocklist(jwt_header, decrypted_token):
-    return decrypted_token['jti'] in BLACKLIST
+    jti = decrypted_token['jti']
+    if redis_client is not None:
+        return bool(redis_client.exists(f"bl:{jti}"))
+    return jti in BLACKLIST
 
 # User management
+# Hashed at the highest cost in use: accounts created before BCRYPT_LOG_ROUNDS was
+# configurable carry flask-bcrypt's default cost of 12, so a cheaper dummy would let
+# unknown emails answer faster than those accounts
+LEGACY_BCRYPT_LOG_ROUNDS = 12
+DUMMY_PASSWORD_HASH = bcrypt.generate_password_hash(
+    "dummy-password", max(app.config["BCRYPT_LOG_ROUNDS"], LEGACY_BCRYPT_LOG_ROUNDS)
+).decode("utf-8")
+
 @app.route("/login", methods=["POST"])
 def login():
-    email = request.json.get("email", None)
-    password = request.json.get("password", None)
+    data = request.get_json(silent=True) or {}
+    email = data.get("email")
+    password = data.get("password")
+    credentials_ok = isinstance(email, str) and isinstance(password, str)
+
+    user = None
+    if credentials_ok:
+        user = db.session.query(User.id, User.password).filter(User.email == email).first()
 
-    user = User.query.filter_by(email=email).first()
+    # Always run a bcrypt comparison, even for missing or malformed fields, so
+    # unknown emails take as long as known ones
+    password_hash = user.password if user else DUMMY_PASSWORD_HASH
+    password_ok = bcrypt.check_password_hash(password_hash, password if credentials_ok else "")
 
-    if user and bcrypt.check_password_hash(user.password, password):
+    if user and password_ok:
         access_token = create_access_token(identity=user.id)
         return jsonify({"access_token": access_token})
 
@@ -85,7 +188,11 @@ def login():
 @jwt_required()
 def logout():
     jti = get_jwt()["jti"]
-    BLACKLIST.add(jti)
+    if redis_client is not None:
+        expires_in = int(app.config["JWT_ACCESS_TOKEN_EXPIRES"].total_seconds())
+        redis_client.setex(f"bl:{jti}", expires_in, 1)
+    else:
+        BLACKLIST.add(jti)
     return jsonify({"success": "Successfully logged out"}), 200
 
 @app.route("/current_user", methods=["GET"])
@@ -105,7 +212,7 @@ def get_current_user():
 
 @app.route("/users", methods=["POST"])
 def create_user():
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
     username = data.get("username")
     email = data.get("email")
     password = data.get("password")
@@ -114,7 +221,11 @@ def create_user():
 
     new_user = User(username=username, email=email, password=hashed_password)
     db.session.add(new_user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"message": "Username or email already exists"}), 400
 
     return jsonify({"message": "User created successfully", "user": new_user.id}), 201
 
@@ -136,7 +247,7 @@ def get_user(user_id):
 @jwt_required()
 def update_user(user_id):
     user = User.query.get_or_404(user_id)
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
 
     if 'username' in data:
         user.username = data['username']
@@ -144,8 +255,12 @@ def update_user(user_id):
         user.email = data['email']
     if 'password' in data:
         user.password = bcrypt.generate_password_hash(data['password']).decode("utf-8")
-        
-    db.session.commit()
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"message": "Username or email already exists"}), 400
     return jsonify({'message': 'User updated successfully'})
 @app.route("/users/<int:user_id>", methods=["DELETE"])
 @jwt_required()
@@ -154,42 +269,115 @@ def delete_user(user_id):
     if not user:
         return jsonify({"message": "User not found"}), 404
 
+    # Payments keep their order (and so the user) from being deleted
+    has_payments = db.session.query(Payment.id).join(Order).filter(Order.user_id == user_id).first() is not None
+    if has_payments:
+        return jsonify({"message": "User has payment records and cannot be deleted"}), 400
+
     db.session.delete(user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"message": "User is still referenced by other records and cannot be deleted"}), 400
 
     return jsonify({"message": "User deleted successfully"}), 200
 
+def strict_loading():
+    # In debug mode make any relationship not loaded up front raise instead of
+    # silently issuing a query per row
+    return (raiseload('*'),) if app.debug else ()
+
 # Product management
 @app.route("/products", methods=["GET"])
+@cache.cached(timeout=60, key_prefix='products_all')
 def list_products():
-    products = Product.query.all()
-    products_data = [{'id': product.id, 'name': product.name, 'price': product.price, 'category': product.category.name} for product in products]
-    return jsonify(products_data)
+    products = (
+        Product.query
+        .options(
+            load_only(Product.id, Product.name, Product.price_cents),
+            joinedload(Product.category).load_only(Category.name),
+            *strict_loading(),
+        )
+        .all()
+    )
+    return jsonify([product.as_dict() for product in products])
+def category_exists(category_id):
+    # Only known categories are cached so newly created ones are seen immediately
+    cache_key = f"category_exists:{category_id}"
+    if cache.get(cache_key):
+        return True
+    exists = db.session.query(Category.id).filter_by(id=category_id).scalar() is not None
+    if exists:
+        cache.set(cache_key, True, timeout=300)
+    return exists
+
 @app.route("/products", methods=["POST"])
 @jwt_required()
 def create_product():
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
     name = data.get("name")
     price = data.get("price")
     category_id = data.get("category_id")
 
-    # Check if category exists
-    category = Category.query.get(category_id)
-    if not category:
+    if not category_exists(category_id):
         return jsonify({"message": "Invalid category ID"}), 400
 
     # Create new product
     new_product = Product(name=name, price=price, category_id=category_id)
     db.session.add(new_product)
     db.session.commit()
+    cache.delete('products_all')
 
     return jsonify({"message": "Product created successfully", "product": new_product.id}), 201
 
+# Cart management
+@app.route("/cart", methods=["GET"])
+@jwt_required()
+def get_cart():
+    user_id = get_jwt_identity()
+    cart = (
+        Cart.query
+        .options(
+            selectinload(Cart.cart_items)
+            .joinedload(CartItem.product)
+            .load_only(Product.id, Product.name, Product.price_cents, Product.image),
+            *strict_loading(),
+        )
+        .filter_by(user_id=user_id)
+        .first()
+    )
+    if not cart:
+        return jsonify({"items": [], "subtotal": from_cents(0)})
+
+    items_data = [item.as_dict() for item in cart.cart_items]
+    # Summed from the rows loaded above so it always matches the items returned
+    subtotal_cents = sum(item.product.price_cents * item.quantity for item in cart.cart_items)
+    return jsonify({"items": items_data, "subtotal": from_cents(subtotal_cents)})
+
 # Order management
+# Carts larger than this are written with COPY when running on psycopg2
+COPY_THRESHOLD = 100
+ORDER_ITEM_COLUMNS = ('order_id', 'product_id', 'quantity', 'price_cents')
+# Other drivers insert order items with one executemany per chunk of this many rows
+ORDER_ITEM_CHUNK_SIZE = 1000
+
+def copy_order_items(rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(str(row[column]) for column in ORDER_ITEM_COLUMNS) + '\n')
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_from(buffer, OrderItem.__tablename__, columns=ORDER_ITEM_COLUMNS, sep='\t')
+    finally:
+        cursor.close()
+
 @app.route("/orders", methods=["POST"])
 @jwt_required()
 def create_order():
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
     user_id = get_jwt_identity()
     cart_items = data.get("cart_items")
     shipping_address_data = data.get("shipping_address")
@@ -197,29 +385,41 @@ def create_order():
     if not cart_items:
         return jsonify({"message": "Cart is empty"}), 400
 
-    new_order = Order(user_id=user_id, total_price=0.0)
-    db.session.add(new_order)
-
-    total_price = 0
-    for item in cart_items:
-        product = Product.query.get(item['product_id'])
-        if not product:
-            return jsonify({"message": f"Product with ID {item['product_id']} not found"}), 400
-        
+    # Fetch every product in the cart with a single query
+    try:
+        product_ids = [int(item['product_id']) for item in cart_items]
+    except (TypeError, ValueError):
+        return jsonify({"message": "Invalid product ID"}), 400
+    products = {product.id: product for product in Product.query.filter(Product.id.in_(product_ids)).all()}
+    missing_ids = set(product_ids) - products.keys()
+    if missing_ids:
+        return jsonify({"message": f"Products not found: {sorted(missing_ids)}"}), 400
+
+    line_cents = []
+    order_item_rows = []
+    for product_id, item in zip(product_ids, cart_items):
         quantity = item.get('quantity', 1)
-        price = product.price * quantity
-        total_price += price
+        cents = products[product_id].price_cents * quantity
+        line_cents.append(cents)
+        order_item_rows.append({'product_id': product_id, 'quantity': quantity, 'price_cents': cents})
 
-        order_item = OrderItem(order=new_order, product=product, quantity=quantity, price=price)
-        db.session.add(order_item)
+    # Flush the order first so its id is available to the order items
+    new_order = Order(user_id=user_id, total_price_cents=sum(line_cents))
+    db.session.add(new_order)
+    db.session.flush()
 
-    # Set the total price
-    new_order.total_price = total_price
+    for row in order_item_rows:
+        row['order_id'] = new_order.id
+    if len(order_item_rows) > COPY_THRESHOLD and db.engine.dialect.driver == 'psycopg2':
+        copy_order_items(order_item_rows)
+    else:
+        for start in range(0, len(order_item_rows), ORDER_ITEM_CHUNK_SIZE):
+            db.session.execute(INSERT_ORDER_ITEM, order_item_rows[start:start + ORDER_ITEM_CHUNK_SIZE])
 
     # Handle shipping address if provided
     if shipping_address_data:
         shipping_address = ShippingAddress(
-            order=new_order,
+            order_id=new_order.id,
             address_line_1=shipping_address_data.get("address_line_1"),
             address_line_2=shipping_address_data.get("address_line_2"),
             city=shipping_address_data.get("city"),
@@ -235,15 +435,17 @@ def create_order():
 @app.route("/payments", methods=["POST"])
 @jwt_required()
 def make_payment():
-    if not request.is_json:
-        return jsonify({"message": "Request must be JSON"}), 400
-
+    # Non-JSON bodies are rejected by get_json() with 415 Unsupported Media Type
     data = request.get_json()
     order_id = data.get("order_id")
     payment_method = data.get("payment_method")
     amount = data.get("amount")
 
-    order = Order.query.get(order_id)
+    if not isinstance(payment_method, str) or payment_method.upper() not in PaymentMethod.__members__:
+        return jsonify({"message": "Invalid payment method"}), 400
+
+    # Only the order row is needed; skip its eager-loaded items and shipping address
+    order = Order.query.options(lazyload('*')).get(order_id)
     if not order or order.is_paid:
         return jsonify({"message": "Invalid order ID or order already paid"}), 400
 
@@ -263,5 +465,6 @@ def make_payment():
 def index():
     return '<h1>Flask is running!</h1>'
 
+# Development server only; production runs under gunicorn (see gunicorn.conf.py)
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port=5555, debug=True)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=5555, debug=os.getenv("FLASK_DEBUG") == "1")
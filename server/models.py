@@ -1,14 +1,19 @@
 from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from enum import IntEnum
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import MetaData, DateTime, func
-from sqlalchemy.orm import validates
+from sqlalchemy import DDL, FetchedValue, MetaData, DateTime, event, func, select
+from sqlalchemy.ext.hybrid import Comparator, hybrid_property
+from sqlalchemy.orm import column_property, validates
 from sqlalchemy_serializer import SerializerMixin
 import re
 
+_USERNAME_RE = re.compile(r"\A\w+\Z")
 
 # Set up SQLAlchemy with metadata naming convention
 metadata = MetaData(
     naming_convention={
+        "ix": "ix_%(column_0_label)s",
         "fk": "fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s",
     }
 )
@@ -16,28 +21,84 @@ metadata = MetaData(
 # Initialize SQLAlchemy
 db = SQLAlchemy(metadata=metadata)
 
+# Money is stored as integer cents and exposed as Decimal through cents_property
+def to_cents(value):
+    if value is None:
+        return None
+    return int((Decimal(str(value)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def from_cents(cents):
+    return None if cents is None else Decimal(cents).scaleb(-2)
+
+def cents_property(column_name):
+    def fget(self):
+        return from_cents(getattr(self, column_name))
+
+    def fset(self, value):
+        setattr(self, column_name, to_cents(value))
+
+    def expr(cls):
+        return getattr(cls, column_name) / 100
+
+    return hybrid_property(fget, fset, expr=expr)
+
+# Key type for small lookup tables; SQLite only autoincrements INTEGER primary keys
+SmallId = db.SmallInteger().with_variant(db.Integer, 'sqlite')
+
 # Association table for many-to-many relationship between User and Role
 user_roles = db.Table(
     'user_roles',
     db.Column('user_id', db.Integer, db.ForeignKey('users.id'), primary_key=True),
-    db.Column('role_id', db.Integer, db.ForeignKey('roles.id'), primary_key=True)
+    db.Column('role_id', SmallId, db.ForeignKey('roles.id'), primary_key=True)
 )
 
 # Product Model
-class Product(db.Model, SerializerMixin):
+class Product(db.Model):
     __tablename__ = 'products'
+    # Partial index for storefront listings; skipped where partial indexes are unsupported
+    __table_args__ = (
+        db.Index(
+            'ix_products_available', 'id',
+            postgresql_where=db.text('is_available IS TRUE'),
+            sqlite_where=db.text('is_available = 1'),
+        ).ddl_if(dialect=('postgresql', 'sqlite')),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(150), nullable=False)
-    category_id = db.Column(db.Integer, db.ForeignKey('categories.id'), nullable=False)
+    category_id = db.Column(SmallId, db.ForeignKey('categories.id', ondelete='CASCADE'), nullable=False, index=True)
     description = db.Column(db.Text, nullable=True)
-    price = db.Column(db.Numeric(10, 2), nullable=False)
+    price_cents = db.Column(db.BigInteger, nullable=False)
+    price = cents_property('price_cents')
     image = db.Column(db.String(255), nullable=True)
     stock = db.Column(db.Integer, default=0)
     is_available = db.Column(db.Boolean, default=True)
+    # Maintained by triggers on reviews (see REVIEW_RATING_TRIGGERS)
+    rating_sum = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    rating_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     created_at = db.Column(DateTime, server_default=func.now())
-    updated_at = db.Column(DateTime, onupdate=func.now())
-
-    category = db.relationship('Category', backref='products', lazy=True, cascade='all, delete-orphan')
+    updated_at = db.Column(DateTime, server_default=func.now(), server_onupdate=FetchedValue())
+
+    category = db.relationship('Category', back_populates='products', lazy=True)
+    order_items = db.relationship('OrderItem', back_populates='product', lazy=True)
+    cart_items = db.relationship('CartItem', back_populates='product', lazy=True)
+    reviews = db.relationship('Review', back_populates='product', lazy=True)
+
+    @hybrid_property
+    def rating_avg(self):
+        return self.rating_sum / self.rating_count if self.rating_count else None
+
+    @rating_avg.expression
+    def rating_avg(cls):
+        return cls.rating_sum / func.nullif(cls.rating_count, 0)
+
+    # Fields returned by GET /products, which loads only these columns and the category name
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'price': self.price,
+            'category': self.category.name
+        }
 
     def __repr__(self):
         return f"<Product {self.name}>"
@@ -45,41 +106,48 @@ class Product(db.Model, SerializerMixin):
 # Role model
 class Role(db.Model, SerializerMixin):
     __tablename__ = 'roles'
-    id = db.Column(db.Integer, primary_key=True)
+    serialize_rules = ('-users',)
+    id = db.Column(SmallId, primary_key=True)
     name = db.Column(db.String(50), unique=True, nullable=False)
     description = db.Column(db.String(255), nullable=True)
 
+    users = db.relationship('User', secondary=user_roles, lazy='dynamic', back_populates='roles')
+
     def __repr__(self):
         return f"<Role {self.name}>"
 
 # User model with many-to-many relationship
 class User(db.Model, SerializerMixin):
     __tablename__ = 'users'
+    serialize_rules = ('-password', '-orders', '-reviews', '-cart', '-roles.users')
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(150), nullable=False, unique=True)
     email = db.Column(db.String(150), nullable=False, unique=True)
     password = db.Column(db.String(150), nullable=False)
     
     created_at = db.Column(DateTime, server_default=func.now())
-    updated_at = db.Column(DateTime, onupdate=func.now())
+    updated_at = db.Column(DateTime, server_default=func.now(), server_onupdate=FetchedValue())
 
     # Many-to-many relationship with roles
-    roles = db.relationship('Role', secondary=user_roles, backref=db.backref('users', lazy='dynamic'))
+    roles = db.relationship('Role', secondary=user_roles, lazy='selectin', back_populates='users')
 
     # Relationships for sellers and buyers
-    orders = db.relationship('Order', backref='user', lazy=True, cascade='all, delete-orphan')
-    reviews = db.relationship('Review', backref='user', lazy=True, cascade='all, delete-orphan')
-    cart = db.relationship('Cart', backref='user', uselist=False, lazy=True, cascade='all, delete-orphan')
+    orders = db.relationship('Order', back_populates='user', lazy=True, cascade='all, delete-orphan', passive_deletes=True)
+    # Reviews are deleted by the ORM, not by an FK cascade: MySQL does not fire
+    # triggers for cascaded deletes, which would leave product ratings stale
+    reviews = db.relationship('Review', back_populates='user', lazy=True, cascade='all, delete-orphan')
+    cart = db.relationship('Cart', back_populates='user', uselist=False, lazy=True, cascade='all, delete-orphan', passive_deletes=True)
+
+    @property
+    def role_names(self):
+        return {role.name for role in self.roles}
 
     @validates('username')
     def validate_username(self, key, username):
         if len(username) < 3 or len(username) > 20:
             raise ValueError("Username must be between 3 and 20 characters")
-        if not re.match(r"^\w+$", username):
+        if not _USERNAME_RE.match(username):
             raise ValueError("Username must contain only letters, numbers, and underscores")
-        existing_user = db.session.query(User).filter_by(username=username).first()
-        if existing_user:
-            raise ValueError("Username already exists")
         return username
 
     def __repr__(self):
@@ -88,80 +156,148 @@ class User(db.Model, SerializerMixin):
 # Category Model
 class Category(db.Model, SerializerMixin):
     __tablename__ = 'categories'
-    id = db.Column(db.Integer, primary_key=True)
+    serialize_rules = ('-products',)
+    id = db.Column(SmallId, primary_key=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
     description = db.Column(db.Text, nullable=True)
     created_at = db.Column(DateTime, server_default=func.now())
-    updated_at = db.Column(DateTime, onupdate=func.now())
+    updated_at = db.Column(DateTime, server_default=func.now(), server_onupdate=FetchedValue())
+
+    products = db.relationship('Product', back_populates='category', lazy=True, cascade='all, delete-orphan', passive_deletes=True)
 
     def __repr__(self):
         return f"<Category {self.name}>"
 
 # Order Model
-class Order(db.Model, SerializerMixin):
+class Order(db.Model):
     __tablename__ = 'orders'
+    # Partial index for the unpaid orders feed, ordered by created_at
+    __table_args__ = (
+        db.Index(
+            'ix_orders_unpaid', 'created_at',
+            postgresql_where=db.text('is_paid IS FALSE'),
+            sqlite_where=db.text('is_paid = 0'),
+        ).ddl_if(dialect=('postgresql', 'sqlite')),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    total_price = db.Column(db.Numeric(10, 2), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    total_price_cents = db.Column(db.BigInteger, nullable=False)
+    total_price = cents_property('total_price_cents')
     is_paid = db.Column(db.Boolean, default=False)
     payment_date = db.Column(db.DateTime, nullable=True)
     created_at = db.Column(DateTime, server_default=func.now())
 
-    order_items = db.relationship('OrderItem', backref='order', lazy=True, cascade='all, delete-orphan')
-    shipping_address = db.relationship('ShippingAddress', backref='order', uselist=False, lazy=True, cascade='all, delete-orphan')
+    user = db.relationship('User', back_populates='orders')
+    order_items = db.relationship('OrderItem', back_populates='order', lazy='selectin', cascade='all, delete-orphan', passive_deletes=True)
+    shipping_address = db.relationship('ShippingAddress', back_populates='order', uselist=False, lazy='joined', cascade='all, delete-orphan', passive_deletes=True)
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'total_price': self.total_price,
+            'is_paid': self.is_paid,
+            'payment_date': self.payment_date,
+            'created_at': self.created_at,
+            'order_items': [item.as_dict() for item in self.order_items]
+        }
 
     def __repr__(self):
         return f"<Order {self.id}>"
 
 # OrderItem Model
-class OrderItem(db.Model, SerializerMixin):
+class OrderItem(db.Model):
     __tablename__ = 'order_items'
+    # Skip the rowcount check after DELETE on child rows
+    __mapper_args__ = {'confirm_deleted_rows': False}
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id', ondelete='CASCADE'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False, index=True)
     quantity = db.Column(db.Integer, nullable=False)
-    price = db.Column(db.Numeric(10, 2), nullable=False)
+    price_cents = db.Column(db.BigInteger, nullable=False)
+    price = cents_property('price_cents')
 
-    product = db.relationship('Product', backref='order_items', lazy=True, cascade='all, delete-orphan')
+    order = db.relationship('Order', back_populates='order_items')
+    product = db.relationship('Product', back_populates='order_items', lazy='joined')
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'product_id': self.product_id,
+            'quantity': self.quantity,
+            'price': self.price
+        }
 
     def __repr__(self):
         return f"<OrderItem {self.id}>"
 
+# Built once and reused with a list of row dicts (executemany), bypassing the ORM
+INSERT_ORDER_ITEM = OrderItem.__table__.insert()
+
+# Order total summed by the database; deferred so it is only selected on request.
+# OrderItem.price_cents already holds the line total (unit price * quantity).
+Order.computed_total_cents = column_property(
+    select(func.coalesce(func.sum(OrderItem.price_cents), 0))
+    .where(OrderItem.order_id == Order.id)
+    .correlate_except(OrderItem)
+    .scalar_subquery(),
+    deferred=True,
+)
+
 # ShippingAddress Model
 class ShippingAddress(db.Model, SerializerMixin):
     __tablename__ = 'shipping_addresses'
+    serialize_rules = ('-order',)
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id', ondelete='CASCADE'), nullable=False, index=True)
     address_line_1 = db.Column(db.String(255), nullable=False)
     address_line_2 = db.Column(db.String(255), nullable=True)
     city = db.Column(db.String(100), nullable=False)
     postal_code = db.Column(db.String(20), nullable=False)
     country = db.Column(db.String(100), nullable=False)
 
+    order = db.relationship('Order', back_populates='shipping_address')
+
     def __repr__(self):
         return f"<ShippingAddress {self.address_line_1}>"
 
 # Cart Model
 class Cart(db.Model, SerializerMixin):
     __tablename__ = 'carts'
+    serialize_rules = ('-user', '-cart_items')
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
     created_at = db.Column(DateTime, server_default=func.now())
 
-    cart_items = db.relationship('CartItem', backref='cart', lazy=True, cascade='all, delete-orphan')
+    user = db.relationship('User', back_populates='cart')
+    cart_items = db.relationship('CartItem', back_populates='cart', lazy='selectin', cascade='all, delete-orphan', passive_deletes=True)
 
     def __repr__(self):
         return f"<Cart {self.id}>"
 
 # CartItem Model
-class CartItem(db.Model, SerializerMixin):
+class CartItem(db.Model):
     __tablename__ = 'cart_items'
+    # One row per product in a cart; also serves lookups on cart_id alone
+    __table_args__ = (db.Index('ix_cart_items_cart_product', 'cart_id', 'product_id', unique=True),)
+    __mapper_args__ = {'confirm_deleted_rows': False}
     id = db.Column(db.Integer, primary_key=True)
-    cart_id = db.Column(db.Integer, db.ForeignKey('carts.id'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    cart_id = db.Column(db.Integer, db.ForeignKey('carts.id', ondelete='CASCADE'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False, index=True)
     quantity = db.Column(db.Integer, nullable=False)
 
-    product = db.relationship('Product', backref='cart_items',lazy=True, cascade='all, delete-orphan')
+    cart = db.relationship('Cart', back_populates='cart_items')
+    product = db.relationship('Product', back_populates='cart_items', lazy='joined')
+
+    # Fields returned by GET /cart, which loads only these product columns
+    def as_dict(self):
+        return {
+            'product_id': self.product_id,
+            'name': self.product.name,
+            'price': self.product.price,
+            'image': self.product.image,
+            'quantity': self.quantity
+        }
 
     def __repr__(self):
         return f"<CartItem {self.id}>"
@@ -169,27 +305,131 @@ class CartItem(db.Model, SerializerMixin):
 # Review Model
 class Review(db.Model, SerializerMixin):
     __tablename__ = 'reviews'
+    # Also serves lookups on product_id alone
+    __table_args__ = (db.Index('ix_reviews_product_rating', 'product_id', 'rating'),)
+    serialize_rules = ('-product', '-user')
+    __mapper_args__ = {'confirm_deleted_rows': False}
     id = db.Column(db.Integer, primary_key=True)
     product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     rating = db.Column(db.Integer, nullable=False)
     comment = db.Column(db.Text, nullable=True)
     created_at = db.Column(DateTime, server_default=func.now())
 
-    product = db.relationship('Product', backref='reviews')
-    user = db.relationship('User', backref='reviews')
+    product = db.relationship('Product', back_populates='reviews')
+    user = db.relationship('User', back_populates='reviews')
 
     def __repr__(self):
         return f"<Review {self.id}>"
 
+# Payment methods are stored as small integer codes
+class PaymentMethod(IntEnum):
+    STRIPE = 1
+    MPESA = 2
+    COD = 3
+
+    @classmethod
+    def from_name(cls, name):
+        return name if isinstance(name, cls) else cls[name.upper()]
+
+# Compares Payment.payment_method against method names by their stored code
+class PaymentMethodComparator(Comparator):
+    def __eq__(self, other):
+        return self.__clause_element__() == PaymentMethod.from_name(other)
+
+    def __ne__(self, other):
+        return self.__clause_element__() != PaymentMethod.from_name(other)
+
 # Payment Model
 class Payment(db.Model, SerializerMixin):
     __tablename__ = 'payments'
+    serialize_rules = ('amount', '-amount_cents', 'payment_method', '-payment_method_code')
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False)
-    amount = db.Column(db.Numeric(10, 2), nullable=False)
-    payment_method = db.Column(db.String(100), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False, index=True)
+    amount_cents = db.Column(db.BigInteger, nullable=False)
+    amount = cents_property('amount_cents')
+    payment_method_code = db.Column(db.SmallInteger, nullable=False)
     payment_date = db.Column(db.DateTime, default=func.now())
 
+    @hybrid_property
+    def payment_method(self):
+        return PaymentMethod(self.payment_method_code).name.lower()
+
+    @payment_method.setter
+    def payment_method(self, name):
+        self.payment_method_code = PaymentMethod.from_name(name)
+
+    @payment_method.comparator
+    def payment_method(cls):
+        return PaymentMethodComparator(cls.payment_method_code)
+
     def __repr__(self):
         return f"<Payment {self.id}>"
+
+# updated_at is maintained by the database; install a trigger per dialect when tables are created
+UPDATED_AT_TRIGGERS = {
+    'sqlite': (
+        "CREATE TRIGGER trg_%(table)s_updated_at AFTER UPDATE ON %(table)s FOR EACH ROW "
+        "BEGIN UPDATE %(table)s SET updated_at = CURRENT_TIMESTAMP WHERE id = NEW.id; END"
+    ),
+    'mysql': (
+        "CREATE TRIGGER trg_%(table)s_updated_at BEFORE UPDATE ON %(table)s FOR EACH ROW "
+        "SET NEW.updated_at = CURRENT_TIMESTAMP"
+    ),
+    'postgresql': (
+        "CREATE OR REPLACE FUNCTION set_updated_at() RETURNS trigger AS $$ "
+        "BEGIN NEW.updated_at = now(); RETURN NEW; END; $$ LANGUAGE plpgsql; "
+        "CREATE TRIGGER trg_%(table)s_updated_at BEFORE UPDATE ON %(table)s FOR EACH ROW "
+        "EXECUTE FUNCTION set_updated_at()"
+    ),
+}
+
+for model in (Product, User, Category):
+    for dialect, statement in UPDATED_AT_TRIGGERS.items():
+        event.listen(model.__table__, 'after_create', DDL(statement).execute_if(dialect=dialect))
+
+# Keep products.rating_sum/rating_count in step with reviews on INSERT, UPDATE and DELETE
+REVIEW_RATING_TRIGGERS = {
+    'sqlite': [
+        "CREATE TRIGGER trg_reviews_rating_insert AFTER INSERT ON reviews FOR EACH ROW BEGIN "
+        "UPDATE products SET rating_sum = rating_sum + NEW.rating, rating_count = rating_count + 1 "
+        "WHERE id = NEW.product_id; END",
+        "CREATE TRIGGER trg_reviews_rating_update AFTER UPDATE OF rating, product_id ON reviews FOR EACH ROW BEGIN "
+        "UPDATE products SET rating_sum = rating_sum - OLD.rating, rating_count = rating_count - 1 "
+        "WHERE id = OLD.product_id; "
+        "UPDATE products SET rating_sum = rating_sum + NEW.rating, rating_count = rating_count + 1 "
+        "WHERE id = NEW.product_id; END",
+        "CREATE TRIGGER trg_reviews_rating_delete AFTER DELETE ON reviews FOR EACH ROW BEGIN "
+        "UPDATE products SET rating_sum = rating_sum - OLD.rating, rating_count = rating_count - 1 "
+        "WHERE id = OLD.product_id; END",
+    ],
+    'mysql': [
+        "CREATE TRIGGER trg_reviews_rating_insert AFTER INSERT ON reviews FOR EACH ROW "
+        "UPDATE products SET rating_sum = rating_sum + NEW.rating, rating_count = rating_count + 1 "
+        "WHERE id = NEW.product_id",
+        "CREATE TRIGGER trg_reviews_rating_update AFTER UPDATE ON reviews FOR EACH ROW BEGIN "
+        "UPDATE products SET rating_sum = rating_sum - OLD.rating, rating_count = rating_count - 1 "
+        "WHERE id = OLD.product_id; "
+        "UPDATE products SET rating_sum = rating_sum + NEW.rating, rating_count = rating_count + 1 "
+        "WHERE id = NEW.product_id; END",
+        "CREATE TRIGGER trg_reviews_rating_delete AFTER DELETE ON reviews FOR EACH ROW "
+        "UPDATE products SET rating_sum = rating_sum - OLD.rating, rating_count = rating_count - 1 "
+        "WHERE id = OLD.product_id",
+    ],
+    'postgresql': [
+        "CREATE OR REPLACE FUNCTION update_product_rating() RETURNS trigger AS $$ BEGIN "
+        "IF TG_OP IN ('UPDATE', 'DELETE') THEN "
+        "UPDATE products SET rating_sum = rating_sum - OLD.rating, rating_count = rating_count - 1 "
+        "WHERE id = OLD.product_id; END IF; "
+        "IF TG_OP IN ('INSERT', 'UPDATE') THEN "
+        "UPDATE products SET rating_sum = rating_sum + NEW.rating, rating_count = rating_count + 1 "
+        "WHERE id = NEW.product_id; END IF; "
+        "RETURN NULL; END; $$ LANGUAGE plpgsql",
+        "CREATE TRIGGER trg_reviews_rating AFTER INSERT OR UPDATE OR DELETE ON reviews FOR EACH ROW "
+        "EXECUTE FUNCTION update_product_rating()",
+    ],
+}
+
+for dialect, statements in REVIEW_RATING_TRIGGERS.items():
+    for statement in statements:
+        event.listen(Review.__table__, 'after_create', DDL(statement).execute_if(dialect=dialect))